@@ -1,9 +1,12 @@
+import asyncio
 import os
 import logging
-from openai import AsyncAzureOpenAI, APIError, APIConnectionError, RateLimitError, AuthenticationError
-from dotenv import load_dotenv
+import random
+import time
+from typing import Optional
 
-load_dotenv()
+import tiktoken
+from openai import AsyncAzureOpenAI, APIError, APIConnectionError, APIStatusError, RateLimitError, AuthenticationError
 
 logger = logging.getLogger(__name__)
 
@@ -13,12 +16,55 @@ AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4.1-mini")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
 
+# Retry settings for rate limit (429), transient server (408, 409, 5xx) and connection errors
+AOAI_MAX_RETRIES = int(os.getenv("AOAI_MAX_RETRIES", "5"))
+AOAI_RETRY_BASE_DELAY = float(os.getenv("AOAI_RETRY_BASE_DELAY", "1"))
+AOAI_RETRY_MAX_DELAY = float(os.getenv("AOAI_RETRY_MAX_DELAY", "30"))
+
+# Tokens-per-minute budget for this service's calls, used for local rate limiting (0 disables it).
+# Each service (extractor, validator) reads its own value, so set it to that service's share of the deployment quota.
+AZURE_OPENAI_TPM_LIMIT = int(os.getenv("AZURE_OPENAI_TPM_LIMIT", "0"))
+
+# Server worker processes for this service; each gets an equal share of AZURE_OPENAI_TPM_LIMIT
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
 
 class AOAIError(Exception):
     """Custom exception for Azure OpenAI errors."""
     pass
 
 
+class AOAITruncatedError(AOAIError):
+    """Raised when a completion stops because it reached max_tokens."""
+    pass
+
+
+class TokenBucket:
+    """Per-process token bucket that paces requests to a tokens-per-minute budget."""
+    
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.refill_rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+    
+    async def acquire(self, n_tokens: int):
+        """Wait until n_tokens are available, then consume them."""
+        n_tokens = min(n_tokens, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < n_tokens:
+                await asyncio.sleep((n_tokens - self.tokens) / self.refill_rate)
+                self._refill()
+            self.tokens -= n_tokens
+
+
 class AOAIHelper:
     """Helper class for Azure OpenAI API calls."""
     
@@ -29,16 +75,101 @@ class AOAIHelper:
         self.client = AsyncAzureOpenAI(
             azure_endpoint=AZURE_OPENAI_ENDPOINT,
             api_key=AZURE_OPENAI_API_KEY,
-            api_version=AZURE_OPENAI_API_VERSION
+            api_version=AZURE_OPENAI_API_VERSION,
+            max_retries=0  # retries are handled in _create_with_retry
         )
         self.model = AZURE_OPENAI_DEPLOYMENT
+        self.token_bucket = (
+            TokenBucket(max(1, AZURE_OPENAI_TPM_LIMIT // WEB_CONCURRENCY)) if AZURE_OPENAI_TPM_LIMIT > 0 else None
+        )
+        
+        # Loaded on first estimate, only when the limiter is on; False once loading has failed
+        self._encoding = None
+    
+    def _get_encoding(self):
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except KeyError:
+            # Deployment names need not match model names; gpt-4o/4.1 models use o200k_base
+            return tiktoken.get_encoding("o200k_base")
+    
+    async def _load_encoding(self):
+        """
+        Load the tiktoken encoding on a worker thread, since the first load may download its BPE file.
+        Falls back to length-based estimates if it cannot be loaded (e.g. no outbound access).
+        """
+        if self._encoding is not None:
+            return
+        try:
+            self._encoding = await asyncio.to_thread(self._get_encoding)
+        except Exception as e:
+            logger.warning(f"tiktoken encoding unavailable, estimating tokens from text length: {e}")
+            self._encoding = False
+    
+    def estimate_tokens(self, system_prompt: str, user_prompt: str, max_tokens: int) -> int:
+        """
+        Estimate the tokens a request counts against the TPM quota:
+        prompt tokens plus the reserved max_tokens.
+        """
+        if not self._encoding:
+            return (len(system_prompt) + len(user_prompt)) // 3 + max_tokens
+        return len(self._encoding.encode(system_prompt)) + len(self._encoding.encode(user_prompt)) + max_tokens
+    
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        """
+        Whether an error is transient: rate limits, connection failures and the
+        408/409/5xx statuses the SDK's built-in retries used to cover.
+        """
+        if isinstance(error, (RateLimitError, APIConnectionError)):
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code in (408, 409) or error.status_code >= 500
+        return False
+    
+    @staticmethod
+    def _retry_delay(attempt: int, error: Exception) -> float:
+        """
+        Seconds to wait before the next attempt. Honors the retry-after headers
+        when present, otherwise uses exponential backoff; both are capped at AOAI_RETRY_MAX_DELAY.
+        """
+        delay = min(AOAI_RETRY_MAX_DELAY, AOAI_RETRY_BASE_DELAY * 2 ** attempt)
+        response = getattr(error, "response", None)
+        if response is not None:
+            headers = response.headers
+            try:
+                if headers.get("retry-after-ms"):
+                    delay = float(headers["retry-after-ms"]) / 1000
+                elif headers.get("retry-after"):
+                    delay = float(headers["retry-after"])
+            except ValueError:
+                pass
+        return min(AOAI_RETRY_MAX_DELAY, delay) + random.uniform(0, 0.5)
+    
+    async def _create_with_retry(self, **params):
+        """
+        Call chat.completions.create, retrying transient errors.
+        """
+        for attempt in range(AOAI_MAX_RETRIES + 1):
+            try:
+                return await self.client.chat.completions.create(**params)
+            except (APIStatusError, APIConnectionError) as e:
+                if attempt == AOAI_MAX_RETRIES or not self._is_retryable(e):
+                    raise
+                delay = self._retry_delay(attempt, e)
+                logger.warning(
+                    f"{type(e).__name__} on attempt {attempt + 1}/{AOAI_MAX_RETRIES + 1}, "
+                    f"retrying in {delay:.2f}s"
+                )
+                await asyncio.sleep(delay)
     
     async def get_completion(
         self,
         system_prompt: str,
         user_prompt: str,
         max_tokens: int = 1000,
-        temperature: float = 0
+        temperature: float = 0,
+        response_format: Optional[dict] = None
     ) -> str:
         """
         Make a call to Azure OpenAI and get the response.
@@ -48,15 +179,26 @@ class AOAIHelper:
             user_prompt: The user instruction prompt.
             max_tokens: Maximum tokens in response.
             temperature: Temperature for response generation.
+            response_format: Optional response format, e.g. {"type": "json_object"} for JSON mode.
         
         Returns:
             The response content from Azure OpenAI.
         
         Raises:
-            AOAIError: If the API call fails.
+            AOAITruncatedError: If the response was cut off at max_tokens.
+            AOAIError: If the API call fails after retries.
         """
+        if self.token_bucket:
+            await self._load_encoding()
+            n_tokens = self.estimate_tokens(system_prompt, user_prompt, max_tokens)
+            await self.token_bucket.acquire(n_tokens)
+        
+        extra_params = {}
+        if response_format:
+            extra_params["response_format"] = response_format
+        
         try:
-            response = await self.client.chat.completions.create(
+            response = await self._create_with_retry(
                 model=self.model,
                 messages=[
                     {
@@ -69,7 +211,8 @@ class AOAIHelper:
                     }
                 ],
                 max_tokens=max_tokens,
-                temperature=temperature
+                temperature=temperature,
+                **extra_params
             )
         except AuthenticationError as e:
             logger.error(f"Authentication failed: {e}")
@@ -87,9 +230,38 @@ class AOAIHelper:
             logger.error(f"Unexpected error during API call: {e}")
             raise AOAIError(f"Failed to call Azure OpenAI: {str(e)}")
         
-        result = response.choices[0].message.content
+        # Log usage so prompt caching on the static system prompt can be verified
+        usage = response.usage
+        if usage:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", None) or 0
+            logger.info(
+                f"Token usage: prompt={usage.prompt_tokens} (cached={cached_tokens}), "
+                f"completion={usage.completion_tokens}"
+            )
+        
+        choice = response.choices[0]
+        
+        if choice.finish_reason == "length":
+            raise AOAITruncatedError(f"Azure OpenAI response was truncated at max_tokens={max_tokens}")
+        
+        result = choice.message.content
         
         if not result:
             raise AOAIError("Empty response from Azure OpenAI")
         
         return result
+
+
+_aoai_helper: Optional[AOAIHelper] = None
+
+
+def get_aoai_helper() -> AOAIHelper:
+    """
+    Return the process-wide AOAIHelper, creating it on first use.
+    Reusing one client keeps its HTTP connection pool warm across requests.
+    """
+    global _aoai_helper
+    if _aoai_helper is None:
+        _aoai_helper = AOAIHelper()
+    return _aoai_helper
@@ -0,0 +1,23 @@
+import re
+
+import orjson
+
+# Matches a markdown code fence, with or without a closing fence
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.S)
+
+
+def parse_json_response(result_text: str):
+    """
+    Parse JSON from an Azure OpenAI response.
+    JSON mode replies are parsed directly; markdown-fenced replies are only unwrapped as a fallback.
+    
+    Raises:
+        orjson.JSONDecodeError: If the response is not valid JSON, fenced or not.
+    """
+    try:
+        return orjson.loads(result_text)
+    except orjson.JSONDecodeError:
+        match = _FENCE_RE.search(result_text)
+        if not match:
+            raise
+        return orjson.loads(match.group(1))
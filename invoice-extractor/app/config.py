@@ -1,10 +1,23 @@
 import os
-from dotenv import load_dotenv
+import sys
+from pathlib import Path
 
-load_dotenv()
+# Add workspace root to path for helpers import
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from helpers.aoai_helper import WEB_CONCURRENCY  # noqa: F401  (uvicorn worker processes, shared with the TPM split)
+
+# .env is loaded once by the entrypoint (app/main.py) before this module is imported
 
 # Azure OpenAI Settings
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4.1-mini")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
+
+# PDF Parsing Settings
+PDF_MAX_CHARS = int(os.getenv("PDF_MAX_CHARS", "12000"))
+
+# Extraction Cache Settings (set EXTRACTION_CACHE_DIR empty to disable the on-disk cache)
+EXTRACTION_CACHE_SIZE = int(os.getenv("EXTRACTION_CACHE_SIZE", "128"))
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", "resource/extraction-cache")
@@ -1,17 +1,24 @@
+import asyncio
 import logging
+import os
 import sys
-from datetime import datetime
+import time
+import uuid
 from pathlib import Path
 
 # Add parent directory to path for module resolution
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-# Load config (this also loads .env)
-import app.config  # noqa: F401
+# Load .env once for local development; deployed environments set variables directly
+from dotenv import load_dotenv
+if not os.getenv("AZURE_OPENAI_ENDPOINT"):
+    load_dotenv()
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import JSONResponse
-from pypdf import PdfReader
+from app.config import WEB_CONCURRENCY
+
+from fastapi import FastAPI, UploadFile, File, HTTPException, Response
+from app.services.pdf_reader import read_pdf_content
+from app.services.extraction_cache import extraction_cache, pdf_digest
 from app.services.invoice_extractor import extract_invoice_details, ExtractionError
 
 # Configure logging
@@ -24,20 +31,20 @@ app = FastAPI(title="Invoice Extractor API")
 UPLOAD_DIR = Path("resource/uploaded-invoices")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# Every PDF file starts with this header
+PDF_MAGIC = b"%PDF-"
+
 
-def read_pdf_content(file_path: Path) -> str:
+def save_uploaded_file(saved_path: Path, file_content: bytes) -> None:
     """
-    Read text content from a PDF file using pypdf.
+    Archive an uploaded PDF to disk. Runs on a worker thread, off the request path.
     """
     try:
-        reader = PdfReader(file_path)
-        text_content = ""
-        for page in reader.pages:
-            text_content += page.extract_text() or ""
-        return text_content
-    except Exception as e:
-        logger.error(f"Failed to read PDF: {e}")
-        raise HTTPException(status_code=400, detail=f"Failed to read PDF file: {str(e)}")
+        with open(saved_path, "wb") as f:
+            f.write(file_content)
+        logger.info(f"File saved: {saved_path}")
+    except IOError as e:
+        logger.error(f"Failed to save file {saved_path}: {e}")
 
 
 @app.get("/")
@@ -46,59 +53,73 @@ async def root():
 
 
 @app.post("/extract")
-async def extract(file: UploadFile = File(...)):
+async def extract(response: Response, file: UploadFile = File(...)) -> dict:
     """
     Extract invoice details from an uploaded PDF file.
     Returns structured JSON with invoice information.
     """
-    if not file.filename.endswith(".pdf"):
+    # Check the PDF header before reading the rest of the upload
+    pdf_header = await file.read(len(PDF_MAGIC))
+    
+    if not pdf_header:
+        raise HTTPException(status_code=400, detail="Empty file uploaded")
+    
+    if pdf_header != PDF_MAGIC:
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     
+    file_content = None
     try:
-        file_content = await file.read()
+        file_content = pdf_header + await file.read()
         
-        if not file_content:
-            raise HTTPException(status_code=400, detail="Empty file uploaded")
+        # Reuse the previous result if this exact PDF was already extracted
+        digest = pdf_digest(file_content)
+        result = extraction_cache.get(digest)
         
-        # Save file with timestamp naming: inv_dd_mm_yyyy_HH_MM_SS.pdf
-        timestamp = datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
-        saved_filename = f"inv_{timestamp}.pdf"
-        saved_path = UPLOAD_DIR / saved_filename
+        if result is None:
+            # Parse PDF bytes in memory and pass text to extractor
+            pdf_text = await read_pdf_content(file_content)
+            
+            if not pdf_text.strip():
+                raise HTTPException(status_code=400, detail="Could not extract text from PDF. The PDF may be image-based or empty.")
+            
+            result = await extract_invoice_details(pdf_text)
+            
+            if "error" not in result:
+                extraction_cache.set(digest, result)
+        else:
+            logger.info(f"Extraction cache hit: {digest}")
         
-        with open(saved_path, "wb") as f:
-            f.write(file_content)
-        
-        logger.info(f"File saved: {saved_path}")
-        
-        # Read PDF content and pass text to extractor
-        pdf_text = read_pdf_content(saved_path)
-        
-        if not pdf_text.strip():
-            raise HTTPException(status_code=400, detail="Could not extract text from PDF. The PDF may be image-based or empty.")
-        
-        result = await extract_invoice_details(pdf_text)
-        return JSONResponse(
-            content={"Extraction": result},
-            headers={
-                "Cache-Control": "no-store, no-cache, max-age=0",
-                "Pragma": "no-cache",
-                "Expires": "0",
-            },
-        )
+        response.headers.update({
+            "Cache-Control": "no-store, no-cache, max-age=0",
+            "Pragma": "no-cache",
+            "Expires": "0",
+        })
+        return {"Extraction": result}
     
     except HTTPException:
         raise
     except ExtractionError as e:
         logger.error(f"Extraction error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    except IOError as e:
-        logger.error(f"File I/O error: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+    finally:
+        # Archive every upload, including ones that fail parsing or extraction, with a unique
+        # name: inv_<epoch_ns>_<random>.pdf. Written on a worker thread so the response is not delayed.
+        if file_content:
+            saved_path = UPLOAD_DIR / f"inv_{time.time_ns()}_{uuid.uuid4().hex[:8]}.pdf"
+            asyncio.get_running_loop().run_in_executor(None, save_uploaded_file, saved_path, file_content)
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # uvloop does not support Windows; "auto" falls back to the default asyncio loop there
+    uvicorn.run(
+        "app.main:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="auto" if sys.platform == "win32" else "uvloop",
+        http="auto" if sys.platform == "win32" else "httptools",
+        workers=WEB_CONCURRENCY
+    )
@@ -0,0 +1,70 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+import diskcache
+import orjson
+
+from app.config import AZURE_OPENAI_DEPLOYMENT, PDF_MAX_CHARS, EXTRACTION_CACHE_SIZE, EXTRACTION_CACHE_DIR
+from app.services.invoice_extractor import SYSTEM_PROMPT, EXTRACTION_PROMPT, EXTRACTION_RESPONSE_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Changes whenever anything that shapes the extraction result changes, so stale on-disk entries are never served
+EXTRACTION_CACHE_VERSION = hashlib.blake2b(
+    orjson.dumps([
+        AZURE_OPENAI_DEPLOYMENT,
+        SYSTEM_PROMPT,
+        EXTRACTION_PROMPT,
+        EXTRACTION_RESPONSE_FORMAT,
+        PDF_MAX_CHARS
+    ]),
+    digest_size=8
+).hexdigest()
+
+
+def pdf_digest(file_content: bytes) -> str:
+    """
+    Cache key for an uploaded PDF: the extraction settings version plus a hash of the PDF bytes.
+    """
+    return f"{EXTRACTION_CACHE_VERSION}:{hashlib.blake2b(file_content, digest_size=16).hexdigest()}"
+
+
+class ExtractionCache:
+    """
+    Extraction results keyed by PDF digest: an in-process LRU in front of an
+    on-disk cache shared between worker processes.
+    """
+    
+    def __init__(self, max_size: int, directory: str):
+        self.max_size = max_size
+        self._memory: OrderedDict = OrderedDict()
+        self._disk = diskcache.Cache(directory) if directory else None
+    
+    def get(self, digest: str) -> Optional[dict]:
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return self._memory[digest]
+        
+        if self._disk is not None:
+            result = self._disk.get(digest)
+            if result is not None:
+                self._remember(digest, result)
+                return result
+        
+        return None
+    
+    def set(self, digest: str, result: dict) -> None:
+        self._remember(digest, result)
+        if self._disk is not None:
+            self._disk.set(digest, result)
+    
+    def _remember(self, digest: str, result: dict) -> None:
+        self._memory[digest] = result
+        self._memory.move_to_end(digest)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+
+extraction_cache = ExtractionCache(EXTRACTION_CACHE_SIZE, EXTRACTION_CACHE_DIR)
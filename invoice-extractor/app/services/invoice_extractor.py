@@ -1,12 +1,14 @@
-import json
 import logging
 import sys
 from pathlib import Path
 
+import orjson
+
 # Add workspace root to path for helpers import
 sys.path.insert(0, str(Path(__file__).parent.parent.parent.parent))
 
-from helpers.aoai_helper import AOAIHelper, AOAIError
+from helpers.aoai_helper import get_aoai_helper, AOAIError, AOAITruncatedError
+from helpers.json_helper import parse_json_response
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +44,53 @@ Follow below rules
 EXTRACTION_PROMPT = """Extract the following details from the invoice pdf text and return in JSON format:
 """
 
+# Completion budget: enough for typical invoices, with one larger retry for long line-item lists
+EXTRACTION_MAX_TOKENS = 500
+EXTRACTION_MAX_TOKENS_RETRY = 2000
+
+# Structured output schema matching SYSTEM_PROMPT, so the model stops as soon as the object is complete
+EXTRACTION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "invoice_extraction",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "OrderNumber": {"type": ["string", "null"]},
+                "InvoiceNumber": {"type": ["string", "null"]},
+                "InvoiceDate": {"type": ["string", "null"]},
+                "InvoiceBaseAmount": {"type": ["number", "null"]},
+                "InvoiceWithTaxAmount": {"type": ["number", "null"]},
+                "InvoiceLineItems": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "LineItemNo": {"type": "number"},
+                            "Product": {"type": ["string", "null"]},
+                            "Quantity": {"type": ["number", "null"]},
+                            "UnitPrice": {"type": ["number", "null"]},
+                            "Amount": {"type": ["number", "null"]}
+                        },
+                        "required": ["LineItemNo", "Product", "Quantity", "UnitPrice", "Amount"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": [
+                "OrderNumber",
+                "InvoiceNumber",
+                "InvoiceDate",
+                "InvoiceBaseAmount",
+                "InvoiceWithTaxAmount",
+                "InvoiceLineItems"
+            ],
+            "additionalProperties": False
+        }
+    }
+}
+
 
 async def extract_invoice_details(pdf_text: str) -> dict:
     """
@@ -54,24 +103,29 @@ async def extract_invoice_details(pdf_text: str) -> dict:
         raise ExtractionError("Could not extract text from PDF")
     
     try:
-        aoai_helper = AOAIHelper()
-        result_text = await aoai_helper.get_completion(
-            system_prompt=SYSTEM_PROMPT,
-            user_prompt=EXTRACTION_PROMPT + pdf_text
-        )
+        aoai_helper = get_aoai_helper()
+        try:
+            result_text = await aoai_helper.get_completion(
+                system_prompt=SYSTEM_PROMPT,
+                user_prompt=EXTRACTION_PROMPT + pdf_text,
+                max_tokens=EXTRACTION_MAX_TOKENS,
+                response_format=EXTRACTION_RESPONSE_FORMAT
+            )
+        except AOAITruncatedError:
+            logger.info(f"Extraction truncated at {EXTRACTION_MAX_TOKENS} tokens, retrying with {EXTRACTION_MAX_TOKENS_RETRY}")
+            result_text = await aoai_helper.get_completion(
+                system_prompt=SYSTEM_PROMPT,
+                user_prompt=EXTRACTION_PROMPT + pdf_text,
+                max_tokens=EXTRACTION_MAX_TOKENS_RETRY,
+                response_format=EXTRACTION_RESPONSE_FORMAT
+            )
     except AOAIError as e:
         raise ExtractionError(str(e))
     
     # Parse JSON from response
     try:
-        # Clean up response if it contains markdown code blocks
-        if "```json" in result_text:
-            result_text = result_text.split("```json")[1].split("```")[0]
-        elif "```" in result_text:
-            result_text = result_text.split("```")[1].split("```")[0]
-        
-        return json.loads(result_text.strip())
-    except json.JSONDecodeError as e:
+        return parse_json_response(result_text)
+    except orjson.JSONDecodeError as e:
         logger.error(f"Failed to parse JSON response: {e}")
         logger.debug(f"Raw response: {result_text}")
         return {"raw_response": result_text, "error": "Failed to parse JSON from AI response"}
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import pymupdf
+from fastapi import HTTPException
+
+from app.config import PDF_MAX_CHARS, WEB_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Share the CPUs between server workers so each one's pool does not oversubscribe the machine
+PDF_WORKERS = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+
+# A first page with less text than this is treated as a scanned (image-only) PDF
+MIN_FIRST_PAGE_CHARS = 20
+
+# PyMuPDF is not thread-safe and holds the GIL, so PDFs are parsed in worker processes.
+# "spawn" avoids forking the threaded server process.
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+
+def _extract_pages(file_content: bytes, max_chars: int) -> Tuple[int, List[str]]:
+    """
+    Extract page texts in order, stopping once max_chars characters are collected,
+    or after the first page if it has no usable text. Runs in a worker process.
+    Returns the document page count and the page texts.
+    """
+    with pymupdf.open(stream=file_content, filetype="pdf") as doc:
+        texts = []
+        total_chars = 0
+        for page in doc:
+            page_text = page.get_text("text")
+            texts.append(page_text)
+            total_chars += len(page_text)
+            if total_chars >= max_chars or len(texts[0].strip()) < MIN_FIRST_PAGE_CHARS:
+                break
+        return doc.page_count, texts
+
+
+async def read_pdf_content(file_content: bytes) -> str:
+    """
+    Read text content from in-memory PDF bytes using PyMuPDF, off the event loop.
+    Stops after PDF_MAX_CHARS characters, since text beyond that is not sent to the model.
+    Rejects PDFs whose first page has no usable text, as scanned PDFs need OCR.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        page_count, chunks = await loop.run_in_executor(_get_pdf_pool(), _extract_pages, file_content, PDF_MAX_CHARS)
+    except Exception as e:
+        logger.error(f"Failed to read PDF: {e}")
+        raise HTTPException(status_code=400, detail=f"Failed to read PDF file: {str(e)}")
+    
+    if page_count == 0:
+        return ""
+    
+    if len(chunks[0].strip()) < MIN_FIRST_PAGE_CHARS:
+        raise HTTPException(status_code=400, detail="PDF appears to be image-based; OCR not enabled")
+    
+    if len(chunks) < page_count:
+        logger.info(
+            f"PDF text truncated after page {len(chunks)} of {page_count} "
+            f"({sum(map(len, chunks))} chars, limit {PDF_MAX_CHARS})"
+        )
+    return "\n".join(chunks)
@@ -2,24 +2,26 @@
 FastAPI wrapper for local development on Windows ARM64.
 Run this instead of Azure Functions for local testing.
 """
-import json
+import asyncio
 import logging
 import os
 import sys
 from pathlib import Path
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
 import aiohttp
+import orjson
 
 # Add workspace root to path for helpers import
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-# Load environment variables
+# Load .env once for local development; deployed environments set variables directly
 from dotenv import load_dotenv
-load_dotenv()
+if not os.getenv("AZURE_OPENAI_ENDPOINT"):
+    load_dotenv()
 
-from helpers.aoai_helper import AOAIHelper, AOAIError
+from helpers.aoai_helper import get_aoai_helper, AOAIError, AOAITruncatedError, WEB_CONCURRENCY
+from helpers.json_helper import parse_json_response
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +31,18 @@ app = FastAPI(title="Invoice Validator API")
 
 # Configuration
 INVOICE_EXTRACTOR_URL = os.getenv("INVOICE_EXTRACTOR_URL", "http://localhost:8000/extract")
+# Must cover the extractor's Azure OpenAI retries (AOAI_MAX_RETRIES x up to AOAI_RETRY_MAX_DELAY seconds)
+INVOICE_EXTRACTOR_TIMEOUT = float(os.getenv("INVOICE_EXTRACTOR_TIMEOUT", "300"))
+LOCAL_INLINE_EXTRACT = os.getenv("LOCAL_INLINE_EXTRACT", "0") == "1"
+
+# Every PDF file starts with this header
+PDF_MAGIC = b"%PDF-"
+
+if LOCAL_INLINE_EXTRACT:
+    # Run extraction in-process instead of calling the extractor over HTTP (requires pymupdf)
+    sys.path.insert(0, str(Path(__file__).parent.parent / "invoice-extractor"))
+    from app.services.pdf_reader import read_pdf_content
+    from app.services.invoice_extractor import extract_invoice_details, ExtractionError
 
 SYSTEM_PROMPT = """You are an invoice validation assistant. Compare the user-provided invoice data with the extracted invoice data and identify any discrepancies.
 
@@ -70,57 +84,96 @@ Return ONLY the JSON object, no additional text.
 
 VALIDATION_PROMPT = """Please validate the following invoice data:
 
-USER PROVIDED DATA:
+USER PROVIDED DATA (JSON):
 {user_data}
 
-EXTRACTED DATA:
+EXTRACTED DATA (JSON):
 {extracted_data}
 
 Compare these two datasets and identify any discrepancies.
 """
 
+# Completion budget: enough for typical invoices, with one larger retry for long line-item lists
+VALIDATION_MAX_TOKENS = 700
+VALIDATION_MAX_TOKENS_RETRY = 2500
+
+
+@app.on_event("startup")
+async def startup():
+    """Create the shared HTTP session used to call the invoice extractor."""
+    app.state.http = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=INVOICE_EXTRACTOR_TIMEOUT),
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=30)
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.http.close()
+
 
-async def call_invoice_extractor(file_content: bytes, filename: str) -> dict:
+async def call_invoice_extractor(session: aiohttp.ClientSession, file_content: bytes, filename: str) -> dict:
     """Call the invoice-extractor API to extract data from PDF."""
-    async with aiohttp.ClientSession() as session:
-        data = aiohttp.FormData()
-        data.add_field('file', file_content, filename=filename, content_type='application/pdf')
-        
+    data = aiohttp.FormData()
+    data.add_field('file', file_content, filename=filename, content_type='application/pdf')
+    
+    try:
         async with session.post(INVOICE_EXTRACTOR_URL, data=data) as response:
             if response.status != 200:
                 error_text = await response.text()
                 raise Exception(f"Invoice extractor returned {response.status}: {error_text}")
             
-            result = await response.json()
+            result = await response.json(loads=orjson.loads)
             return result.get("Extraction", result)
+    except asyncio.TimeoutError:
+        raise Exception(f"Invoice extractor did not respond within {INVOICE_EXTRACTOR_TIMEOUT:g} seconds")
+
+
+async def extract_invoice_inline(file_content: bytes) -> dict:
+    """Extract data from PDF in-process using the invoice-extractor service code."""
+    pdf_text = await read_pdf_content(file_content)
+    
+    if not pdf_text.strip():
+        raise HTTPException(status_code=400, detail="Could not extract text from PDF. The PDF may be image-based or empty.")
+    
+    try:
+        return await extract_invoice_details(pdf_text)
+    except ExtractionError as e:
+        raise HTTPException(status_code=500, detail=f"Extraction failed: {str(e)}")
 
 
 async def validate_invoice(user_invoice: dict, extracted_invoice: dict) -> dict:
     """Use AOAI to compare user invoice data with extracted data."""
-    aoai_helper = AOAIHelper()
+    aoai_helper = get_aoai_helper()
     
-    user_data_str = json.dumps(user_invoice, indent=2)
-    extracted_data_str = json.dumps(extracted_invoice, indent=2)
+    user_data_str = orjson.dumps(user_invoice).decode()
+    extracted_data_str = orjson.dumps(extracted_invoice).decode()
     
     prompt = VALIDATION_PROMPT.format(
         user_data=user_data_str,
         extracted_data=extracted_data_str
     )
     
-    result_text = await aoai_helper.get_completion(
-        system_prompt=SYSTEM_PROMPT,
-        user_prompt=prompt
-    )
+    try:
+        result_text = await aoai_helper.get_completion(
+            system_prompt=SYSTEM_PROMPT,
+            user_prompt=prompt,
+            max_tokens=VALIDATION_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        )
+    except AOAITruncatedError:
+        logger.info(f"Validation truncated at {VALIDATION_MAX_TOKENS} tokens, retrying with {VALIDATION_MAX_TOKENS_RETRY}")
+        result_text = await aoai_helper.get_completion(
+            system_prompt=SYSTEM_PROMPT,
+            user_prompt=prompt,
+            max_tokens=VALIDATION_MAX_TOKENS_RETRY,
+            response_format={"type": "json_object"}
+        )
     
     # Parse JSON from response
     try:
-        if "```json" in result_text:
-            result_text = result_text.split("```json")[1].split("```")[0]
-        elif "```" in result_text:
-            result_text = result_text.split("```")[1].split("```")[0]
-        
-        return json.loads(result_text.strip())
-    except json.JSONDecodeError:
+        return parse_json_response(result_text)
+    except orjson.JSONDecodeError:
         return {"raw_response": result_text, "error": "Failed to parse validation response"}
 
 
@@ -133,7 +186,7 @@ async def root():
 async def validate_invoice_endpoint(
     file: UploadFile = File(...),
     data: str = Form(...)
-):
+) -> dict:
     """
     Validate invoice by comparing user data with extracted PDF data.
     
@@ -143,14 +196,15 @@ async def validate_invoice_endpoint(
     logger.info('Invoice validation triggered.')
     
     try:
-        # Validate file
-        if not file.filename.endswith('.pdf'):
+        # Validate file by its PDF header before reading the rest
+        pdf_header = await file.read(len(PDF_MAGIC))
+        if pdf_header != PDF_MAGIC:
             raise HTTPException(status_code=400, detail="Only PDF files are supported")
         
         # Parse JSON data
         try:
-            request_data = json.loads(data)
-        except json.JSONDecodeError:
+            request_data = orjson.loads(data)
+        except orjson.JSONDecodeError:
             raise HTTPException(status_code=400, detail="Invalid JSON in 'data' field")
         
         user_invoice = request_data.get("Invoice")
@@ -158,11 +212,15 @@ async def validate_invoice_endpoint(
             raise HTTPException(status_code=400, detail="Missing 'Invoice' object in request data")
         
         # Read PDF content
-        file_content = await file.read()
+        file_content = pdf_header + await file.read()
         
-        # Call invoice extractor API
-        logger.info(f"Calling invoice extractor for file: {file.filename}")
-        extracted_data = await call_invoice_extractor(file_content, file.filename)
+        if LOCAL_INLINE_EXTRACT:
+            logger.info(f"Extracting invoice in-process for file: {file.filename}")
+            extracted_data = await extract_invoice_inline(file_content)
+        else:
+            # Call invoice extractor API
+            logger.info(f"Calling invoice extractor for file: {file.filename}")
+            extracted_data = await call_invoice_extractor(app.state.http, file_content, file.filename)
         
         if "error" in extracted_data:
             raise HTTPException(status_code=500, detail=f"Extraction failed: {extracted_data['error']}")
@@ -176,7 +234,7 @@ async def validate_invoice_endpoint(
             "Validation": validation_result
         }
         
-        return JSONResponse(content=response)
+        return response
     
     except HTTPException:
         raise
@@ -190,4 +248,12 @@ async def validate_invoice_endpoint(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=7071)
+    # uvloop does not support Windows (including ARM64); "auto" falls back to the default asyncio loop there
+    uvicorn.run(
+        "app_local:app",
+        host="127.0.0.1",
+        port=7071,
+        loop="auto" if sys.platform == "win32" else "uvloop",
+        http="auto" if sys.platform == "win32" else "httptools",
+        workers=WEB_CONCURRENCY
+    )
@@ -1,19 +1,31 @@
-import json
+import asyncio
 import logging
 import os
 import sys
 from pathlib import Path
+from typing import Optional
 
 import azure.functions as func
 import aiohttp
+import orjson
 
 # Add workspace root to path for helpers import
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from helpers.aoai_helper import AOAIHelper, AOAIError
+from helpers.aoai_helper import get_aoai_helper, AOAIError, AOAITruncatedError
+from helpers.json_helper import parse_json_response
 
 # Configuration
 INVOICE_EXTRACTOR_URL = os.getenv("INVOICE_EXTRACTOR_URL", "http://localhost:8000/extract")
+# Must cover the extractor's Azure OpenAI retries (AOAI_MAX_RETRIES x up to AOAI_RETRY_MAX_DELAY seconds)
+INVOICE_EXTRACTOR_TIMEOUT = float(os.getenv("INVOICE_EXTRACTOR_TIMEOUT", "300"))
+
+# Every PDF file starts with this header
+PDF_MAGIC = b"%PDF-"
+
+# Shared HTTP session, reused across invocations on the same worker
+_http_session: Optional[aiohttp.ClientSession] = None
+_http_session_lock = asyncio.Lock()
 
 SYSTEM_PROMPT = """You are an invoice validation assistant. Compare the user-provided invoice data with the extracted invoice data and identify any discrepancies.
 
@@ -55,61 +67,88 @@ Return ONLY the JSON object, no additional text.
 
 VALIDATION_PROMPT = """Please validate the following invoice data:
 
-USER PROVIDED DATA:
+USER PROVIDED DATA (JSON):
 {user_data}
 
-EXTRACTED DATA:
+EXTRACTED DATA (JSON):
 {extracted_data}
 
 Compare these two datasets and identify any discrepancies.
 """
 
+# Completion budget: enough for typical invoices, with one larger retry for long line-item lists
+VALIDATION_MAX_TOKENS = 700
+VALIDATION_MAX_TOKENS_RETRY = 2500
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """
+    Return the worker-wide HTTP session, creating it on first use.
+    """
+    global _http_session
+    async with _http_session_lock:
+        if _http_session is None or _http_session.closed:
+            _http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=INVOICE_EXTRACTOR_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=30)
+            )
+        return _http_session
+
 
 async def call_invoice_extractor(file_content: bytes, filename: str) -> dict:
     """
     Call the invoice-extractor API to extract data from PDF.
     """
-    async with aiohttp.ClientSession() as session:
-        data = aiohttp.FormData()
-        data.add_field('file', file_content, filename=filename, content_type='application/pdf')
-        
+    session = await get_http_session()
+    data = aiohttp.FormData()
+    data.add_field('file', file_content, filename=filename, content_type='application/pdf')
+    
+    try:
         async with session.post(INVOICE_EXTRACTOR_URL, data=data) as response:
             if response.status != 200:
                 error_text = await response.text()
                 raise Exception(f"Invoice extractor returned {response.status}: {error_text}")
             
-            result = await response.json()
+            result = await response.json(loads=orjson.loads)
             return result.get("Extraction", result)
+    except asyncio.TimeoutError:
+        raise Exception(f"Invoice extractor did not respond within {INVOICE_EXTRACTOR_TIMEOUT:g} seconds")
 
 
 async def validate_invoice(user_invoice: dict, extracted_invoice: dict) -> dict:
     """
     Use AOAI to compare user invoice data with extracted data.
     """
-    aoai_helper = AOAIHelper()
+    aoai_helper = get_aoai_helper()
     
-    user_data_str = json.dumps(user_invoice, indent=2)
-    extracted_data_str = json.dumps(extracted_invoice, indent=2)
+    user_data_str = orjson.dumps(user_invoice).decode()
+    extracted_data_str = orjson.dumps(extracted_invoice).decode()
     
     prompt = VALIDATION_PROMPT.format(
         user_data=user_data_str,
         extracted_data=extracted_data_str
     )
     
-    result_text = await aoai_helper.get_completion(
-        system_prompt=SYSTEM_PROMPT,
-        user_prompt=prompt
-    )
+    try:
+        result_text = await aoai_helper.get_completion(
+            system_prompt=SYSTEM_PROMPT,
+            user_prompt=prompt,
+            max_tokens=VALIDATION_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        )
+    except AOAITruncatedError:
+        logging.info(f"Validation truncated at {VALIDATION_MAX_TOKENS} tokens, retrying with {VALIDATION_MAX_TOKENS_RETRY}")
+        result_text = await aoai_helper.get_completion(
+            system_prompt=SYSTEM_PROMPT,
+            user_prompt=prompt,
+            max_tokens=VALIDATION_MAX_TOKENS_RETRY,
+            response_format={"type": "json_object"}
+        )
     
     # Parse JSON from response
     try:
-        if "```json" in result_text:
-            result_text = result_text.split("```json")[1].split("```")[0]
-        elif "```" in result_text:
-            result_text = result_text.split("```")[1].split("```")[0]
-        
-        return json.loads(result_text.strip())
-    except json.JSONDecodeError:
+        return parse_json_response(result_text)
+    except orjson.JSONDecodeError:
         return {"raw_response": result_text, "error": "Failed to parse validation response"}
 
 
@@ -127,14 +166,16 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         pdf_file = req.files.get('file')
         if not pdf_file:
             return func.HttpResponse(
-                json.dumps({"error": "No PDF file provided. Use 'file' field in multipart form."}),
+                orjson.dumps({"error": "No PDF file provided. Use 'file' field in multipart form."}),
                 status_code=400,
                 mimetype="application/json"
             )
         
-        if not pdf_file.filename.endswith('.pdf'):
+        # Validate file by its PDF header before reading the rest
+        pdf_header = pdf_file.read(len(PDF_MAGIC))
+        if pdf_header != PDF_MAGIC:
             return func.HttpResponse(
-                json.dumps({"error": "Only PDF files are supported"}),
+                orjson.dumps({"error": "Only PDF files are supported"}),
                 status_code=400,
                 mimetype="application/json"
             )
@@ -143,16 +184,16 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         data_str = req.form.get('data')
         if not data_str:
             return func.HttpResponse(
-                json.dumps({"error": "No invoice data provided. Use 'data' field with JSON string."}),
+                orjson.dumps({"error": "No invoice data provided. Use 'data' field with JSON string."}),
                 status_code=400,
                 mimetype="application/json"
             )
         
         try:
-            request_data = json.loads(data_str)
-        except json.JSONDecodeError:
+            request_data = orjson.loads(data_str)
+        except orjson.JSONDecodeError:
             return func.HttpResponse(
-                json.dumps({"error": "Invalid JSON in 'data' field"}),
+                orjson.dumps({"error": "Invalid JSON in 'data' field"}),
                 status_code=400,
                 mimetype="application/json"
             )
@@ -160,13 +201,13 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         user_invoice = request_data.get("Invoice")
         if not user_invoice:
             return func.HttpResponse(
-                json.dumps({"error": "Missing 'Invoice' object in request data"}),
+                orjson.dumps({"error": "Missing 'Invoice' object in request data"}),
                 status_code=400,
                 mimetype="application/json"
             )
         
         # Read PDF content
-        file_content = pdf_file.read()
+        file_content = pdf_header + pdf_file.read()
         
         # Call invoice extractor API
         logging.info(f"Calling invoice extractor for file: {pdf_file.filename}")
@@ -174,7 +215,7 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         
         if "error" in extracted_data:
             return func.HttpResponse(
-                json.dumps({"error": f"Extraction failed: {extracted_data['error']}"}),
+                orjson.dumps({"error": f"Extraction failed: {extracted_data['error']}"}),
                 status_code=500,
                 mimetype="application/json"
             )
@@ -189,7 +230,7 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
         }
         
         return func.HttpResponse(
-            json.dumps(response, indent=2),
+            orjson.dumps(response, option=orjson.OPT_INDENT_2),
             status_code=200,
             mimetype="application/json"
         )
@@ -197,14 +238,14 @@ async def main(req: func.HttpRequest) -> func.HttpResponse:
     except AOAIError as e:
         logging.error(f"AOAI error: {e}")
         return func.HttpResponse(
-            json.dumps({"error": f"AI validation failed: {str(e)}"}),
+            orjson.dumps({"error": f"AI validation failed: {str(e)}"}),
             status_code=500,
             mimetype="application/json"
         )
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
         return func.HttpResponse(
-            json.dumps({"error": f"Validation failed: {str(e)}"}),
+            orjson.dumps({"error": f"Validation failed: {str(e)}"}),
             status_code=500,
             mimetype="application/json"
         )